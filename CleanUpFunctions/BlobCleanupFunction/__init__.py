@@ -1,111 +1,367 @@
+import asyncio
 import logging
 import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
-from datetime import datetime, timezone
+from dataclasses import dataclass
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.blob.aio import BlobServiceClient, ExponentialRetry
+from datetime import datetime, timedelta, timezone
 import os
 
-def main(mytimer: func.TimerRequest) -> None:
+# Deletes are network-bound; cap the batch deletes in flight across all containers
+MAX_CONCURRENT_DELETES = 50
+
+# Containers listed at once; bounds listing pages held in memory and open connections
+MAX_CONCURRENT_CONTAINERS = 10
+
+# The blob batch API accepts at most 256 sub-requests per call
+DELETE_BATCH_SIZE = 256
+
+# Maximum page size the list blobs API returns
+LIST_PAGE_SIZE = 5000
+
+# Containers requested per list containers page
+CONTAINER_PAGE_SIZE = 500
+
+# SDK retry policy for throttled or transiently failed requests: exponential
+# backoff of initial + base ** n seconds, the last retry waiting roughly a minute
+RETRY_TOTAL = 10
+RETRY_INITIAL_BACKOFF = 1
+RETRY_INCREMENT_BASE = 1.5
+
+# Resubmits of throttled blobs within a batch. Each attempt already goes through
+# the SDK retry policy, so keep these few. RESUBMIT_TIME_BUDGET caps the wall time
+# of a whole batch, SDK retries included; the attempt in flight is cancelled when
+# it runs out.
+RESUBMIT_TOTAL = 4
+RESUBMIT_INITIAL_BACKOFF = 1.0
+RESUBMIT_BACKOFF_MAX = 60
+RESUBMIT_TIME_BUDGET = 120
+
+# Batch sub-response statuses worth resubmitting
+RETRYABLE_STATUS_CODES = {429, 500, 503}
+
+# Per-blob detail is only logged at debug level; emit a progress line at this interval instead
+PROGRESS_LOG_INTERVAL = 10000
+
+
+@dataclass(frozen=True)
+class _Config:
+    account_name: str
+    retention_days: int
+    tag_filter: str
+
+
+def _load_config():
+    account_name = os.environ.get("STORAGE_ACCOUNT_NAME")
+
+    tag_filter = os.environ.get("ARCHIVE_TAG_FILTER", "")
+
+    # Validate configuration
+    if not account_name:
+        raise ValueError("STORAGE_ACCOUNT_NAME environment variable is not set")
+
+    # Every blob the tag filter matches is deleted, so it must carry the age condition
+    if tag_filter and "{cutoff}" not in tag_filter:
+        raise ValueError("ARCHIVE_TAG_FILTER must reference the retention cutoff with a {cutoff} placeholder")
+
+    return _Config(
+        account_name=account_name,
+        retention_days=int(os.environ.get("RETENTION_DAYS", "90")),
+        tag_filter=tag_filter,
+    )
+
+
+# Parsed once at import so a misconfigured app fails when it is loaded rather
+# than on the first timer fire
+CONFIG = _load_config()
+
+# Kept at module scope so warm invocations reuse the connection pool and cached token
+_credential = DefaultAzureCredential()
+_blob_service_client = None
+
+
+def _client():
+    global _blob_service_client
+    if _blob_service_client is None:
+        account_url = f"https://{CONFIG.account_name}.blob.core.windows.net"
+        logging.info(f"Connecting to storage account: {account_url}")
+        _blob_service_client = BlobServiceClient(
+            account_url,
+            credential=_credential,
+            retry_policy=ExponentialRetry(
+                initial_backoff=RETRY_INITIAL_BACKOFF, increment_base=RETRY_INCREMENT_BASE, retry_total=RETRY_TOTAL),
+        )
+    return _blob_service_client
+
+
+def _retry_after_seconds(response):
+    # Throttled sub-responses may say how long to wait before retrying. Values that
+    # do not parse as a number (e.g. the HTTP-date form of Retry-After) return 0
+    # so the computed backoff is used instead.
+    try:
+        retry_after_ms = response.headers.get("x-ms-retry-after-ms")
+        if retry_after_ms:
+            return int(retry_after_ms) / 1000
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            return float(retry_after)
+    except ValueError:
+        logging.warning("Ignoring unparseable retry-after header on throttled blob delete")
+    return 0
+
+
+async def _delete_attempt(container_client, blob_names, can_resubmit):
+    container_name = container_client.container_name
+    deleted = 0
+    errors = 0
+    throttled = []
+    retry_after = 0
+    responses = await container_client.delete_blobs(*blob_names, raise_on_any_failure=False)
+    index = 0
+    async for response in responses:
+        blob_name = blob_names[index]
+        index += 1
+        if response.status_code == 202:
+            deleted += 1
+        elif response.status_code == 404:
+            logging.warning(f"Blob not found (already deleted?): {container_name}/{blob_name}")
+            errors += 1
+        elif response.status_code in RETRYABLE_STATUS_CODES and can_resubmit:
+            throttled.append(blob_name)
+            retry_after = max(retry_after, _retry_after_seconds(response))
+        else:
+            logging.error(f"Error deleting blob {container_name}/{blob_name}: HTTP {response.status_code}")
+            errors += 1
+    return deleted, errors, throttled, retry_after
+
+
+async def _delete_batch(container_client, blob_names, semaphore):
+    container_name = container_client.container_name
+    batch_size = len(blob_names)
+    deleted = 0
+    errors = 0
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RESUBMIT_TIME_BUDGET
+    try:
+        for attempt in range(RESUBMIT_TOTAL + 1):
+            # The budget covers each whole attempt, including the SDK's own retries
+            # inside delete_blobs, so a batch never runs past RESUBMIT_TIME_BUDGET
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            attempt_deleted, attempt_errors, throttled, retry_after = await asyncio.wait_for(
+                _delete_attempt(container_client, blob_names, attempt < RESUBMIT_TOTAL), remaining)
+            deleted += attempt_deleted
+            errors += attempt_errors
+
+            if not throttled:
+                break
+
+            # Resubmit only the throttled blobs, honoring the service's requested delay
+            # but never waiting past the cap or the batch's time budget. The batch keeps
+            # its slot while waiting so throttling slows the whole pipeline.
+            delay = retry_after or RESUBMIT_INITIAL_BACKOFF * 2 ** attempt
+            delay = min(delay, RESUBMIT_BACKOFF_MAX, max(deadline - loop.time(), 0))
+            logging.warning(f"{len(throttled)} blob deletes throttled in {container_name}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            blob_names = throttled
+    except asyncio.TimeoutError:
+        # Outcome of the blobs still in flight is unknown; count them as errors
+        logging.error(f"Timed out after {RESUBMIT_TIME_BUDGET}s deleting batch of {batch_size} blobs "
+                      f"from {container_name}; {deleted} deleted")
+        return deleted, batch_size - deleted
+    except Exception as delete_error:
+        logging.error(f"Error deleting batch of {batch_size} blobs from {container_name}: {str(delete_error)}")
+        return deleted, batch_size - deleted
+    finally:
+        semaphore.release()
+
+    logging.info(f"Deleted {deleted} of {batch_size} blobs in batch from {container_name}")
+    return deleted, errors
+
+
+async def _submit_batch(container_client, blob_names, semaphore, delete_tasks):
+    # Waiting for a free slot before starting the task pauses listing while the
+    # delete pipeline is full, keeping the names held in memory bounded
+    await semaphore.acquire()
+    delete_tasks.append(asyncio.create_task(_delete_batch(container_client, blob_names, semaphore)))
+
+
+async def _process_container(container_client, cutoff, semaphore, container_semaphore):
+    # Wait for a container slot before opening the listing
+    async with container_semaphore:
+        container_name = container_client.container_name
+        logging.info(f"Processing container: {container_name}")
+
+        processed_count = 0
+        eligible_count = 0
+        error_count = 0
+        delete_tasks = []
+        debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+        pending = []
+
+        try:
+            # Page through the listing rather than materializing it; no optional
+            # properties are requested since only tier and last modified are needed;
+            # batches fill across page boundaries so every submitted batch is full
+            async for blob in container_client.list_blobs(results_per_page=LIST_PAGE_SIZE):
+                processed_count += 1
+                if processed_count % PROGRESS_LOG_INTERVAL == 0:
+                    logging.info(f"Processed {processed_count} blobs in container {container_name}, "
+                                 f"{eligible_count} eligible for deletion so far")
+
+                # Only archived blobs are candidates for deletion
+                tier = blob.blob_tier
+                if tier != 'Archive':
+                    continue
+
+                # Check if blob is at or past the retention cutoff
+                last_modified = blob.last_modified
+                if last_modified <= cutoff:
+                    name = blob.name
+                    if debug_enabled:
+                        logging.debug(f"Deleting blob {name} (last modified: {last_modified})")
+                    pending.append(name)
+                    eligible_count += 1
+                    if len(pending) >= DELETE_BATCH_SIZE:
+                        await _submit_batch(container_client, pending, semaphore, delete_tasks)
+                        pending = []
+                elif debug_enabled:
+                    logging.debug(f"Skipping blob {blob.name} (tier: {tier}, last modified: {last_modified})")
+
+            logging.info(f"Found {processed_count} blobs in container {container_name}, "
+                         f"{eligible_count} eligible for deletion")
+
+        except Exception as container_error:
+            logging.error(f"Error processing container {container_name}: {str(container_error)}")
+            error_count += 1
+
+        # Flush the final partial batch, including candidates found before any listing failure
+        if pending:
+            await _submit_batch(container_client, pending, semaphore, delete_tasks)
+
+        # Wait for any deletes already submitted, even if listing failed part way
+        deleted_count = 0
+        for batch_deleted, batch_errors in await asyncio.gather(*delete_tasks):
+            deleted_count += batch_deleted
+            error_count += batch_errors
+
+        return processed_count, deleted_count, error_count
+
+
+async def _process_tagged_blobs(blob_service_client, tag_filter, semaphore):
+    # Every match is a deletion candidate, so the filter must encode both the tier
+    # and the age condition; blobs are grouped per container for the batch API
+    processed_count = 0
+    error_count = 0
+    delete_tasks = []
+    pending = {}
+
+    try:
+        async for blob in blob_service_client.find_blobs_by_tags(tag_filter, results_per_page=LIST_PAGE_SIZE):
+            processed_count += 1
+            if processed_count % PROGRESS_LOG_INTERVAL == 0:
+                logging.info(f"Found {processed_count} tagged blobs so far")
+
+            blob_names = pending.setdefault(blob.container_name, [])
+            blob_names.append(blob.name)
+            if len(blob_names) >= DELETE_BATCH_SIZE:
+                pending[blob.container_name] = []
+                await _submit_batch(
+                    blob_service_client.get_container_client(blob.container_name), blob_names, semaphore, delete_tasks)
+
+        for container_name, blob_names in pending.items():
+            if blob_names:
+                await _submit_batch(
+                    blob_service_client.get_container_client(container_name), blob_names, semaphore, delete_tasks)
+
+        logging.info(f"Found {processed_count} tagged blobs across {len(pending)} containers")
+
+    except Exception as tag_error:
+        logging.error(f"Error finding blobs by tags: {str(tag_error)}")
+        error_count += 1
+
+    # Wait for any deletes already submitted, even if the query failed part way
+    deleted_count = 0
+    for batch_deleted, batch_errors in await asyncio.gather(*delete_tasks):
+        deleted_count += batch_deleted
+        error_count += batch_errors
+
+    return len(pending), processed_count, deleted_count, error_count
+
+
+async def main(mytimer: func.TimerRequest) -> None:
     logging.info('Blob cleanup function triggered')
 
     if mytimer.past_due:
         logging.info('The timer is past due!')
 
     try:
-        # Get configuration and log it
-        account_name = os.environ.get("STORAGE_ACCOUNT_NAME")
-        retention_days = int(os.environ.get("RETENTION_DAYS", "90"))
-        
-        # Validate configuration
-        if not account_name:
-            raise ValueError("STORAGE_ACCOUNT_NAME environment variable is not set")
-            
-        logging.info(f"Configuration: Storage Account: {account_name}, Retention Days: {retention_days}")
-        
-        # Create the credential and log token acquisition
-        logging.info("Acquiring managed identity token...")
-        credential = DefaultAzureCredential()
-        
-        # Create the BlobServiceClient
-        account_url = f"https://{account_name}.blob.core.windows.net"
-        logging.info(f"Connecting to storage account: {account_url}")
-        blob_service_client = BlobServiceClient(account_url, credential=credential)
+        logging.info(f"Configuration: Storage Account: {CONFIG.account_name}, Retention Days: {CONFIG.retention_days}, "
+                     f"Tag Filter: {'Yes' if CONFIG.tag_filter else 'No'}")
+
+        # Get the shared BlobServiceClient, created on the first invocation of this instance
+        blob_service_client = _client()
 
         # Verify storage account access
         try:
-            account_info = blob_service_client.get_account_information()
+            account_info = await blob_service_client.get_account_information()
             logging.info(f"Successfully connected to storage account. SKU: {account_info['sku_name']}")
         except Exception as account_error:
             logging.error(f"Failed to access storage account: {str(account_error)}")
             raise
 
-        # Get all containers with error handling
-        try:
-            logging.info("Listing containers...")
-            containers = list(blob_service_client.list_containers())
-            logging.info(f"Found {len(containers)} containers")
-        except Exception as container_error:
-            logging.error(f"Error listing containers: {str(container_error)}")
-            raise
-        
-        deleted_count = 0
-        processed_count = 0
-        error_count = 0
+        # A blob is deleted once it is more than RETENTION_DAYS whole days old,
+        # i.e. at least RETENTION_DAYS + 1 days since it was last modified
+        cutoff = datetime.now(timezone.utc) - timedelta(days=CONFIG.retention_days + 1)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DELETES)
+        container_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONTAINERS)
 
-        # Process each container
-        for container in containers:
-            logging.info(f"Processing container: {container.name}")
-            container_client = blob_service_client.get_container_client(container.name)
-            
+        if CONFIG.tag_filter:
+            # Let the blob index return only the candidates, across all containers in one query
+            tag_filter = CONFIG.tag_filter.format(cutoff=cutoff.strftime("%Y-%m-%dT%H:%M:%SZ"))
+            logging.info(f"Finding blobs by tag filter: {tag_filter}")
+            container_count, processed_count, deleted_count, error_count = await _process_tagged_blobs(
+                blob_service_client, tag_filter, semaphore)
+        else:
+            # Start processing each container as soon as the listing returns it, so
+            # listing pages overlap with work on containers already found. Containers
+            # run concurrently on the event loop; the semaphore caps batch deletes in
+            # flight across every container, and at most MAX_CONCURRENT_CONTAINERS are
+            # listed at once.
+            container_tasks = []
             try:
-                # List all blobs in the container
-                blobs = list(container_client.list_blobs())
-                logging.info(f"Found {len(blobs)} blobs in container {container.name}")
-                
-                for blob in blobs:
-                    processed_count += 1
-                    
-                    # Log blob details for debugging
-                    logging.info(f"Processing blob: {blob.name}")
-                    logging.info(f"Blob tier: {blob.blob_tier}")
-                    logging.info(f"Last modified: {blob.last_modified}")
-                    
-                    # Calculate age in days
-                    age_days = (datetime.now(timezone.utc) - blob.last_modified).days
-                    logging.info(f"Blob age: {age_days} days")
-                    
-                    # Check if blob should be deleted
-                    if (blob.blob_tier == 'Archive' and age_days > retention_days):
-                        try:
-                            container_client.delete_blob(blob.name)
-                            deleted_count += 1
-                            logging.info(f"Successfully deleted blob: {container.name}/{blob.name}")
-                        except ResourceNotFoundError:
-                            logging.warning(f"Blob not found (already deleted?): {container.name}/{blob.name}")
-                            error_count += 1
-                        except Exception as delete_error:
-                            logging.error(f"Error deleting blob {container.name}/{blob.name}: {str(delete_error)}")
-                            error_count += 1
-                    else:
-                        logging.info(f"Skipping blob {blob.name} (tier: {blob.blob_tier}, age: {age_days} days)")
-                
+                logging.info("Listing containers...")
+                async for container in blob_service_client.list_containers(results_per_page=CONTAINER_PAGE_SIZE):
+                    container_tasks.append(asyncio.create_task(_process_container(
+                        blob_service_client.get_container_client(container.name), cutoff, semaphore,
+                        container_semaphore)))
+                logging.info(f"Found {len(container_tasks)} containers")
             except Exception as container_error:
-                logging.error(f"Error processing container {container.name}: {str(container_error)}")
-                error_count += 1
-                continue
+                logging.error(f"Error listing containers: {str(container_error)}")
+                # Let containers already started finish before failing the run
+                await asyncio.gather(*container_tasks)
+                raise
+
+            results = await asyncio.gather(*container_tasks)
+
+            container_count = len(container_tasks)
+            deleted_count = 0
+            processed_count = 0
+            error_count = 0
+            for container_processed, container_deleted, container_errors in results:
+                processed_count += container_processed
+                deleted_count += container_deleted
+                error_count += container_errors
 
         # Log summary
         logging.info(f"Cleanup Summary:")
-        logging.info(f"- Processed containers: {len(containers)}")
+        logging.info(f"- Processed containers: {container_count}")
         logging.info(f"- Total blobs processed: {processed_count}")
         logging.info(f"- Blobs deleted: {deleted_count}")
         logging.info(f"- Errors encountered: {error_count}")
 
-    except ValueError as ve:
-        logging.error(f"Configuration error: {str(ve)}")
-        raise
     except Exception as e:
         logging.error(f"Error in blob cleanup function: {str(e)}")
         logging.error(f"Error type: {type(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -1,126 +1,231 @@
 import logging
 import azure.functions as func
+from dataclasses import dataclass
 import pyodbc
 from azure.identity import DefaultAzureCredential
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
+
+# Rows deleted per statement; small chunks avoid lock escalation and log growth
+DELETE_CHUNK_SIZE = 5000
+
+# Deletes one chunk of rows older than the cutoff; comparing the column directly
+# against a parameter keeps the predicate sargable so an index on it can be used
+CHUNK_DELETE_SQL = "DELETE TOP (?) FROM {table} WHERE {column} < ?"
+
+# Row counts from catalog metadata for every user table (heap or clustered index)
+# in the caller's default schema, which is where the unqualified DELETEs resolve
+TABLE_ROW_ESTIMATES_SQL = """
+SELECT t.name, SUM(p.rows)
+FROM sys.tables AS t
+JOIN sys.partitions AS p ON p.object_id = t.object_id AND p.index_id IN (0, 1)
+WHERE SCHEMA_NAME(t.schema_id) = SCHEMA_NAME()
+GROUP BY t.name
+"""
+
+
+@dataclass(frozen=True)
+class _Config:
+    server: str
+    database: str
+    retention_days: int
+
+
+def _load_config():
+    server = os.environ.get("SQL_SERVER")
+    database = os.environ.get("SQL_DATABASE")
+
+    if not server or not database:
+        raise ValueError("Missing required environment variables: SQL_SERVER and/or SQL_DATABASE")
+
+    return _Config(
+        server=server,
+        database=database,
+        retention_days=int(os.environ.get("RETENTION_DAYS", "90")),
+    )
+
+
+# Parsed once at import so a misconfigured app fails when it is loaded rather
+# than on the first timer fire
+CONFIG = _load_config()
+
+# Newest first; Driver 18 has the faster TDS path and supports TLS 1.3
+PREFERRED_ODBC_DRIVERS = ["ODBC Driver 18 for SQL Server", "ODBC Driver 17 for SQL Server"]
+
+# MARS allows interleaved cursors; TCP keep-alive stops idle connections being torn
+# down between timer invocations
+CONNECTION_OPTIONS = "MARS_Connection=Yes;KeepAlive=30;KeepAliveInterval=5;"
+
+# Let the driver manager pool connections; must be set before the first connect
+pyodbc.pooling = True
+
+# Refresh the cached access token once it is this close to expiring, in seconds
+TOKEN_REFRESH_MARGIN = 300
+
+SQL_TOKEN_SCOPE = "https://database.windows.net/.default"
+
+# Kept at module scope so warm invocations skip the connection handshake and
+# reuse the managed identity token
+_credential = DefaultAzureCredential()
+_token = None
+_conn = None
+
+
+def _odbc_driver():
+    # Prefer the newest SQL Server driver installed on the worker
+    installed = pyodbc.drivers()
+    for driver in PREFERRED_ODBC_DRIVERS:
+        if driver in installed:
+            return driver
+    return PREFERRED_ODBC_DRIVERS[-1]
+
+
+def _get_token():
+    global _token
+    if _token is None or _token.expires_on - time.time() < TOKEN_REFRESH_MARGIN:
+        # Get access token using managed identity
+        _token = _credential.get_token(SQL_TOKEN_SCOPE)
+        logging.info("Successfully acquired token")
+    return _token
+
+
+def _connect(server, database):
+    # Connection string with Authentication
+    driver = _odbc_driver()
+    conn_str = (
+        f"Driver={{{driver}}};"
+        f"Server=tcp:{server},1433;"
+        f"Database={database};"
+        "Authentication=ActiveDirectoryMSI;"  # Add this line
+        "Encrypt=yes;"
+        "TrustServerCertificate=no;"
+        "Connection Timeout=30;"
+        f"{CONNECTION_OPTIONS}"
+    )
+
+    logging.info("Attempting to connect to database...")
+    logging.info(f"Connection string (masked): Driver={{{driver}}};Server=tcp:{server},1433;Database={database}")
+
+    try:
+        # Try connecting without token first
+        logging.info("Attempting connection with MSI authentication...")
+        conn = pyodbc.connect(conn_str)
+        logging.info("Successfully connected to database using MSI authentication")
+    except pyodbc.Error as msi_error:
+        logging.warning(f"MSI authentication failed: {str(msi_error)}")
+        logging.info("Attempting connection with access token...")
+        try:
+            # Fallback to token-based connection
+            conn_str_token = (
+                f"Driver={{{driver}}};"
+                f"Server=tcp:{server},1433;"
+                f"Database={database};"
+                "Encrypt=yes;"
+                "TrustServerCertificate=no;"
+                "Connection Timeout=30;"
+                f"{CONNECTION_OPTIONS}"
+            )
+            token = _get_token()
+            conn = pyodbc.connect(conn_str_token, attrs_before={1256: token.token})
+            logging.info("Successfully connected to database using access token")
+        except pyodbc.Error as token_error:
+            logging.error(f"Token authentication failed: {str(token_error)}")
+            raise
+
+    # Test the connection with a simple query
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("SELECT @@VERSION")
+            version = cursor.fetchone()[0]
+            logging.info(f"Connected to SQL Server version: {version}")
+        except Exception as test_error:
+            logging.error(f"Error testing connection: {str(test_error)}")
+            raise
+
+    return conn
+
+
+def _get_conn(server, database):
+    global _conn
+    if _conn is not None:
+        try:
+            with _conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            logging.info("Reusing existing database connection")
+            return _conn
+        except pyodbc.Error as ping_error:
+            logging.warning(f"Cached database connection is no longer usable, reconnecting: {str(ping_error)}")
+            try:
+                _conn.close()
+            except pyodbc.Error:
+                pass
+            _conn = None
+
+    _conn = _connect(server, database)
+    return _conn
+
 
 def main(mytimer: func.TimerRequest) -> None:
     logging.info('Database cleanup function triggered')
 
     try:
-        # Log environment variables (mask sensitive data)
-        server = os.environ.get("SQL_SERVER")
-        database = os.environ.get("SQL_DATABASE")
-        retention_days = os.environ.get("RETENTION_DAYS", "90")
-
-        logging.info(f"SQL_SERVER configured: {'Yes' if server else 'No'}")
-        logging.info(f"SQL_DATABASE configured: {'Yes' if database else 'No'}")
-        logging.info(f"RETENTION_DAYS configured: {retention_days}")
+        logging.info(f"RETENTION_DAYS configured: {CONFIG.retention_days}")
 
-        if not server or not database:
-            raise ValueError("Missing required environment variables: SQL_SERVER and/or SQL_DATABASE")
+        # Computed once so every chunk uses the same cutoff; naive UTC to match
+        # GETDATE() on Azure SQL
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=CONFIG.retention_days)
+        logging.info(f"Deleting rows older than {cutoff.isoformat()} UTC")
 
         # Log available ODBC drivers
         logging.info("Available ODBC drivers:")
         logging.info(pyodbc.drivers())
 
-        # Get access token using managed identity
-        credential = DefaultAzureCredential()
-        token = credential.get_token("https://database.windows.net/.default")
-        logging.info("Successfully acquired token")
+        conn = _get_conn(CONFIG.server, CONFIG.database)
 
-        # Connection string with Authentication
-        conn_str = (
-            f"Driver={{ODBC Driver 17 for SQL Server}};"
-            f"Server=tcp:{server},1433;"
-            f"Database={database};"
-            "Authentication=ActiveDirectoryMSI;"  # Add this line
-            "Encrypt=yes;"
-            "TrustServerCertificate=no;"
-            "Connection Timeout=30;"
-        )
-        
-        logging.info("Attempting to connect to database...")
-        logging.info(f"Connection string (masked): Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:{server},1433;Database={database}")
+        # Scope work to a cursor only; the connection stays open for reuse
+        with conn.cursor() as cursor:
+            # (table, date column) pairs to purge
+            cleanup_targets = [
+                ("Logs", "CreatedDate"),
+                ("AuditTrail", "Timestamp"),
+            ]
 
-        try:
-            # Try connecting without token first
-            logging.info("Attempting connection with MSI authentication...")
-            conn = pyodbc.connect(conn_str)
-            logging.info("Successfully connected to database using MSI authentication")
-        except pyodbc.Error as msi_error:
-            logging.warning(f"MSI authentication failed: {str(msi_error)}")
-            logging.info("Attempting connection with access token...")
-            try:
-                # Fallback to token-based connection
-                conn_str_token = (
-                    f"Driver={{ODBC Driver 17 for SQL Server}};"
-                    f"Server=tcp:{server},1433;"
-                    f"Database={database};"
-                    "Encrypt=yes;"
-                    "TrustServerCertificate=no;"
-                    "Connection Timeout=30;"
-                )
-                conn = pyodbc.connect(conn_str_token, attrs_before={1256: token.token})
-                logging.info("Successfully connected to database using access token")
-            except pyodbc.Error as token_error:
-                logging.error(f"Token authentication failed: {str(token_error)}")
-                raise
-
-        with conn:
-            # Test the connection with a simple query
-            with conn.cursor() as cursor:
+            # Look up which tables exist, with their approximate row counts, once rather
+            # than once per target; catalog row counts avoid a COUNT(*) scan of each table
+            cursor.execute(TABLE_ROW_ESTIMATES_SQL)
+            table_row_estimates = {row[0]: row[1] for row in cursor.fetchall()}
+
+            total_deleted = 0
+            for table_name, date_column in cleanup_targets:
+                # Chunks are committed as they go, so count them as soon as they are durable
+                deleted_rows = 0
                 try:
-                    cursor.execute("SELECT @@VERSION")
-                    version = cursor.fetchone()[0]
-                    logging.info(f"Connected to SQL Server version: {version}")
-                except Exception as test_error:
-                    logging.error(f"Error testing connection: {str(test_error)}")
-                    raise
-
-                cleanup_queries = [
-                    """
-                    DELETE FROM Logs 
-                    WHERE CreatedDate < DATEADD(day, ?, GETDATE())
-                    """,
-                    """
-                    DELETE FROM AuditTrail 
-                    WHERE Timestamp < DATEADD(day, ?, GETDATE())
-                    """
-                ]
-
-                total_deleted = 0
-                for query in cleanup_queries:
-                    try:
-                        # First check if the table exists
-                        table_name = query.split("FROM")[1].split("WHERE")[0].strip()
-                        cursor.execute(f"SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{table_name}'")
-                        if cursor.fetchone()[0] == 0:
-                            logging.warning(f"Table {table_name} does not exist, skipping...")
-                            continue
-
-                        # Count records to be deleted
-                        count_query = query.replace("DELETE FROM", "SELECT COUNT(*) FROM")
-                        cursor.execute(count_query, -int(retention_days))
-                        to_delete_count = cursor.fetchone()[0]
-                        logging.info(f"Found {to_delete_count} records to delete from {table_name}")
-
-                        # Execute the delete
-                        cursor.execute(query, -int(retention_days))
-                        deleted_rows = cursor.rowcount
-                        total_deleted += deleted_rows
-                        logging.info(f"Deleted {deleted_rows} rows from {table_name}")
+                    if table_name not in table_row_estimates:
+                        logging.warning(f"Table {table_name} does not exist, skipping...")
+                        continue
+                    logging.info(f"Table {table_name} has approximately {table_row_estimates[table_name]} rows")
+
+                    # Delete in chunks, committing after each one so locks are held only
+                    # briefly and the transaction log can be truncated between chunks
+                    delete_query = CHUNK_DELETE_SQL.format(table=table_name, column=date_column)
+                    while True:
+                        cursor.execute(delete_query, DELETE_CHUNK_SIZE, cutoff)
+                        chunk_rows = cursor.rowcount
                         conn.commit()
-                    except Exception as query_error:
-                        logging.error(f"Error executing query on {table_name}: {str(query_error)}")
-                        conn.rollback()
+                        deleted_rows += chunk_rows
+                        total_deleted += chunk_rows
+                        if chunk_rows < DELETE_CHUNK_SIZE:
+                            break
+                    logging.info(f"Deleted {deleted_rows} rows from {table_name}")
+                except Exception as query_error:
+                    logging.error(f"Error executing query on {table_name} after {deleted_rows} rows "
+                                  f"were deleted and committed: {str(query_error)}")
+                    conn.rollback()
 
-                logging.info(f"Database cleanup completed. Total rows deleted: {total_deleted}")
+            logging.info(f"Database cleanup completed. Total rows deleted: {total_deleted}")
 
-    except ValueError as ve:
-        logging.error(f"Configuration error: {str(ve)}")
-        raise
     except Exception as e:
         logging.error(f"Error in database cleanup function: {str(e)}")
         logging.error(f"Error type: {type(e)}")